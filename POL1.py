@@ -1,9 +1,13 @@
-import requests
+import asyncio
+import aiohttp
+import hashlib
+import logging
 import time
-import json
+import orjson
 import os
-from typing import Dict, Any, List
-from datetime import datetime, timedelta
+import random
+from itertools import chain
+from typing import Dict, Any, List, Tuple, Union
 
 # ================== 配置区 ==================
 
@@ -15,79 +19,253 @@ FEISHU_WEBHOOK = "b"
 STATE_FILE = "state.json"
 POLL_INTERVAL = 30  # 秒
 
+# 🧹 去重配置：重启后首轮不再重复推送近期已发送过的仓位变化
+DEDUP_FILE = "dedup.json"
+DEDUP_TTL = 3600  # 已发送变化的记忆时长（秒）
+DEDUP_MAXSIZE = 1000  # 最多记忆的变化条数
+
 # 🎯 变化容忍阈值：小于此值的变化将被忽略
 CHANGE_THRESHOLD = 0.01  # 可根据实际情况调整，例如 0.01 = 1% 或 0.01 个单位
 
 # 🔁 重试配置
 MAX_RETRY_DURATION = 60  # 最大重试时长（秒）
-RETRY_INTERVAL = 10  # 每次重试间隔（秒）
+RETRY_INTERVAL_BASE = 1  # 首次重试间隔（秒），之后按 1、2、4、8… 指数递增
+RETRY_INTERVAL_MAX = 30  # 单次重试间隔上限（秒）
+
+# 📦 合并推送配置
+ALERT_SEPARATOR = "\n\n━━━━━\n\n"  # 多条提醒之间的分隔线
+FEISHU_MAX_BYTES = 20 * 1024  # 单条飞书消息请求体（JSON 编码后）上限（字节）
+
+# ================== 日志 ==================
+
+logger = logging.getLogger("pol")
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+logger.addHandler(_handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False  # 已有自己的 handler，避免根 logger 配置后重复输出
+
+# ================== 提醒模板 ==================
+
+OPEN_TMPL = (
+    "【新开仓】\n"
+    "{title} - {outcome}\n"
+    "数量：{size}\n"
+    "均价：{avg_price}\n"
+    "现价：{cur_price}"
+)
+
+ADD_TMPL = (
+    "【加仓】\n"
+    "{title} - {outcome}\n"
+    "{old:.4f} → {new:.4f} (+{delta:.4f})\n"
+    "均价：{avg_price}\n"
+    "PNL：{pnl}%"
+)
+
+REDUCE_TMPL = (
+    "【减仓】\n"
+    "{title} - {outcome}\n"
+    "{old:.4f} → {new:.4f} (-{delta:.4f})\n"
+    "现价：{cur_price}\n"
+    "PNL：{pnl}%"
+)
+
+CLEAR_TMPL = (
+    "【清仓】\n"
+    "{title} - {outcome}\n"
+    "{old:.4f} → 0"
+)
+
+# ================== HTTP 会话 ==================
+
+# 🔌 复用连接：轮询 API 与飞书推送共用 main 中创建的同一个 ClientSession，避免每次请求重新握手
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+def create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+    return aiohttp.ClientSession(
+        connector=connector,
+        json_serialize=lambda obj: orjson.dumps(obj).decode("utf-8")
+    )
 
 # ================== API ==================
 
-def fetch_positions() -> List[Dict[str, Any]]:
+# 🏷️ 条件请求：记录上次响应的 ETag，数据未变化时服务端返回 304
+UNCHANGED = object()  # 仓位数据与上次相同的哨兵值
+_etag = None
+
+async def fetch_positions(session: aiohttp.ClientSession) -> Union[List[Dict[str, Any]], object]:
+    global _etag
+
     params = {
         "user": USER_ADDRESS,
         "limit": 100,
         "sizeThreshold": 1
     }
-    r = requests.get(API_URL, params=params, timeout=10)
-    r.raise_for_status()
-    return r.json()
+    headers = {"If-None-Match": _etag} if _etag else {}
+    async with session.get(API_URL, params=params, headers=headers, timeout=REQUEST_TIMEOUT) as r:
+        if r.status == 304:
+            return UNCHANGED
+        r.raise_for_status()
+        positions = orjson.loads(await r.read())
+
+    # 响应体完整读取并解析成功后才记录 ETag，否则重试时会被 304 误判为未变化
+    _etag = r.headers.get("ETag")
+    return positions
 
 # ================== 状态读写 ==================
 
+# 上次写入 state.json 的内容，用于跳过无变化的重复写入
+_last_state_bytes = None
+
 def load_state() -> Dict[str, Any]:
     if not os.path.exists(STATE_FILE):
         return {}
-    with open(STATE_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(STATE_FILE, "rb") as f:
+        state = orjson.loads(f.read())
+
+    # 加载时统一转换一次 size，比对时直接使用浮点数
+    for v in state.values():
+        v["size"] = float(v["size"])
+    return state
 
 def save_state(state: Dict[str, Any]):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    global _last_state_bytes
+
+    data = orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS)
+    if data == _last_state_bytes:
+        return
+
+    write_file_atomic(STATE_FILE, data)
+    _last_state_bytes = data
+
+def write_file_atomic(path: str, data: bytes):
+    # 先写临时文件再原子替换，避免写到一半中断留下空文件
+    tmp = path + ".tmp"
+    with open(tmp, "wb", buffering=64 * 1024) as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# ================== 提醒去重 ==================
+
+def load_dedup() -> Dict[str, float]:
+    """
+    读取已推送的仓位变化记录（摘要 → 发送时间），丢弃超过 DEDUP_TTL 的记录
+    """
+    if not os.path.exists(DEDUP_FILE):
+        return {}
+    with open(DEDUP_FILE, "rb") as f:
+        saved = orjson.loads(f.read())
+
+    now = time.time()
+    return {d: t for d, t in saved.items() if now - t < DEDUP_TTL}
+
+def save_dedup(sent: Dict[str, float]):
+    # 写入前清理过期记录，超过上限时只保留最近发送的记录
+    now = time.time()
+    fresh = [(d, t) for d, t in sent.items() if now - t < DEDUP_TTL]
+    sent.clear()
+    sent.update(fresh[-DEDUP_MAXSIZE:])
+    write_file_atomic(DEDUP_FILE, orjson.dumps(sent))
+
+def event_digest(event: str) -> str:
+    return hashlib.blake2b(event.encode("utf-8"), digest_size=8).hexdigest()
+
+def filter_sent_alerts(
+    alerts: List[Tuple[str, str]],
+    sent: Dict[str, float]
+) -> List[Tuple[str, str]]:
+    """
+    过滤掉已推送过的仓位变化，仅用于重启后的首轮；
+    正常运行时同一变化再次出现属于真实的重复操作，照常推送
+    
+    Args:
+        alerts: 本轮产生的 (仓位变化标识, 提醒文本) 列表
+        sent: 已推送变化的摘要 → 发送时间
+    
+    Returns:
+        需要推送的 (仓位变化标识, 提醒文本) 列表
+    """
+    return [a for a in alerts if event_digest(a[0]) not in sent]
+
+def mark_sent(alerts: List[Tuple[str, str]], sent: Dict[str, float]):
+    now = time.time()
+    for event, _ in alerts:
+        digest = event_digest(event)
+        # 先删除再写入，保持字典按发送时间排序
+        sent.pop(digest, None)
+        sent[digest] = now
 
 # ================== 飞书推送 ==================
 
-def send_feishu(text: str):
-    payload = {
+def feishu_payload(text: str) -> Dict[str, Any]:
+    return {
         "msg_type": "text",
         "content": {
             "text": text
         }
     }
+
+async def send_feishu(session: aiohttp.ClientSession, text: str) -> bool:
+    """
+    推送一条飞书文本消息，失败时只记录日志
+    
+    Returns:
+        True 表示推送成功
+    """
+    payload = feishu_payload(text)
     try:
-        r = requests.post(FEISHU_WEBHOOK, json=payload, timeout=10)
-        r.raise_for_status()
+        async with session.post(FEISHU_WEBHOOK, json=payload, timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()
+        return True
     except Exception as e:
-        print(f"飞书推送失败: {e}")
-
-# ================== 判断数值变化是否显著 ==================
+        logger.warning("飞书推送失败: %s: %s", type(e).__name__, e)
+        return False
 
-def is_significant_change(old_size: float, new_size: float, threshold: float = CHANGE_THRESHOLD) -> bool:
+def batch_alerts(
+    alerts: List[Tuple[str, str]],
+    max_bytes: int = FEISHU_MAX_BYTES
+) -> List[List[Tuple[str, str]]]:
     """
-    判断仓位变化是否显著（超过阈值）
+    将多条提醒分组，每组用 ALERT_SEPARATOR 合并为一条飞书消息后，JSON 请求体不超过 max_bytes
     
     Args:
-        old_size: 旧仓位大小
-        new_size: 新仓位大小
-        threshold: 容忍阈值
+        alerts: (仓位变化标识, 提醒文本) 列表
+        max_bytes: 单条消息请求体上限（JSON 编码后的字节数）
     
     Returns:
-        True 表示变化显著，False 表示可能是浮点噪音
+        分组后的提醒列表，每组对应一条飞书消息
     """
-    diff = abs(new_size - old_size)
-    
-    # 方案1: 绝对差值判断（适合固定单位的变化）
-    if diff < threshold:
-        return False
-    
-    # 方案2: 相对变化判断（可选，适合百分比变化）
-    # if old_size > 0:
-    #     relative_change = diff / old_size
-    #     if relative_change < threshold:  # threshold 可设为 0.01 即 1%
-    #         return False
-    
-    return True
+    def encoded_len(text: str) -> int:
+        # JSON 字符串转义后的长度（去掉两侧引号），换行等字符会变成两个字节
+        return len(orjson.dumps(text)) - 2
+
+    # 请求体中除正文外的固定开销
+    base_bytes = len(orjson.dumps(feishu_payload("")))
+    sep_bytes = encoded_len(ALERT_SEPARATOR)
+
+    batches = []
+    current = []
+    current_bytes = base_bytes
+
+    for alert in alerts:
+        msg_bytes = encoded_len(alert[1])
+        extra = msg_bytes + (sep_bytes if current else 0)
+
+        if current and current_bytes + extra > max_bytes:
+            batches.append(current)
+            current = []
+            current_bytes = base_bytes
+            extra = msg_bytes
+
+        current.append(alert)
+        current_bytes += extra
+
+    if current:
+        batches.append(current)
+
+    return batches
 
 # ================== 仓位变化检测 ==================
 
@@ -95,112 +273,101 @@ def detect_position_changes(
     old_state: Dict[str, Any],
     new_positions: List[Dict[str, Any]]
 ):
+    # 每条提醒为 (仓位变化标识, 提醒文本)，标识为 "复合键|旧数量|新数量"，供重启后去重使用
     alerts = []
-    new_state = {}
+    threshold = CHANGE_THRESHOLD  # 局部变量，循环内免去全局查找
 
-    for p in new_positions:
-        cid = p["conditionId"]
-        outcome = p.get("outcome", "")
-        size = float(p["size"])
-        
-        # 🔑 使用复合键区分同一市场的不同仓位
-        key = f"{cid}:{outcome}"
-        
-        # 忽略已清仓的仓位
-        if size == 0:
-            continue
-
-        title = p.get("title", "")
-        avg_price = p.get("avgPrice")
-        cur_price = p.get("curPrice")
-        percent_pnl = p.get("percentPnl")
-
-        new_state[key] = {
+    # 阶段一：按复合键整理当前仓位，区分同一市场的不同仓位，忽略已清仓的仓位
+    live = {
+        f"{p['conditionId']}:{p.get('outcome', '')}": (size, p)
+        for p in new_positions
+        if (size := float(p["size"])) != 0
+    }
+    new_state = {
+        key: {
             "size": size,
-            "avgPrice": avg_price,
-            "title": title,
-            "outcome": outcome
+            "avgPrice": p.get("avgPrice"),
+            "title": p.get("title", ""),
+            "outcome": p.get("outcome", "")
         }
+        for key, (size, p) in live.items()
+    }
 
-        old = old_state.get(key)  # 用复合键查找
+    # 阶段二：逐个复合键比对新旧状态（先按接口顺序处理当前仓位，再处理已消失的仓位）
+    for key in chain(new_state, (k for k in old_state if k not in new_state)):
+        old = old_state.get(key)
+        new = new_state.get(key)
+
+        # 已清仓（从接口结果中消失）
+        if new is None:
+            old_size = old["size"]
+            if old_size > 0:
+                alerts.append((f"{key}|{old_size}|0", CLEAR_TMPL.format(
+                    title=old["title"], outcome=old["outcome"], old=old_size
+                )))
+            continue
+
+        size = new["size"]
+        title = new["title"]
+        outcome = new["outcome"]
+        avg_price = new["avgPrice"]
+        p = live[key][1]
 
         # 新开仓
-        if old is None and size > 0:
-            alerts.append(
-                f"【新开仓】\n"
-                f"{title} - {outcome}\n"
-                f"数量：{size}\n"
-                f"均价：{avg_price}\n"
-                f"现价：{cur_price}"
-            )
-
-        elif old:
-            old_size = float(old["size"])
-            
-            if not is_significant_change(old_size, size):
-                continue
-
-            if size > old_size:
-                alerts.append(
-                    f"【加仓】\n"
-                    f"{title} - {outcome}\n"
-                    f"{old_size:.4f} → {size:.4f} (+{size - old_size:.4f})\n"
-                    f"均价：{avg_price}\n"
-                    f"PNL：{percent_pnl}%"
-                )
+        if old is None:
+            if size > 0:
+                alerts.append((f"{key}||{size}", OPEN_TMPL.format(
+                    title=title, outcome=outcome, size=size,
+                    avg_price=avg_price, cur_price=p.get("curPrice")
+                )))
+            continue
 
-            elif 0 < size < old_size:
-                alerts.append(
-                    f"【减仓】\n"
-                    f"{title} - {outcome}\n"
-                    f"{old_size:.4f} → {size:.4f} (-{old_size - size:.4f})\n"
-                    f"现价：{cur_price}\n"
-                    f"PNL：{percent_pnl}%"
-                )
+        old_size = old["size"]
 
-            elif size == 0 and old_size > 0:
-                alerts.append(
-                    f"【清仓】\n"
-                    f"{title} - {outcome}\n"
-                    f"{old_size:.4f} → 0"
-                )
-    
-    # 检测已清仓的仓位
-    for key, old_data in old_state.items():
-        if key not in new_state:
-            old_size = float(old_data["size"])
-            if old_size > 0:
-                alerts.append(
-                    f"【清仓】\n"
-                    f"{old_data['title']} - {old_data['outcome']}\n"
-                    f"{old_size:.4f} → 0"
-                )
+        # 过滤浮点精度抖动：绝对差值小于阈值（含数量完全相同）时直接跳过
+        # 如需按相对变化判断，可改为 abs(size - old_size) / old_size < threshold
+        if abs(size - old_size) < threshold:
+            continue
+
+        if size > old_size:
+            alerts.append((f"{key}|{old_size}|{size}", ADD_TMPL.format(
+                title=title, outcome=outcome,
+                old=old_size, new=size, delta=size - old_size,
+                avg_price=avg_price, pnl=p.get("percentPnl")
+            )))
+
+        elif 0 < size < old_size:
+            alerts.append((f"{key}|{old_size}|{size}", REDUCE_TMPL.format(
+                title=title, outcome=outcome,
+                old=old_size, new=size, delta=old_size - size,
+                cur_price=p.get("curPrice"), pnl=p.get("percentPnl")
+            )))
 
     return alerts, new_state
 
 # ================== 带重试的API调用 ==================
 
-def fetch_positions_with_retry() -> List[Dict[str, Any]]:
+async def fetch_positions_with_retry(session: aiohttp.ClientSession) -> Union[List[Dict[str, Any]], object]:
     """
     带重试机制的仓位获取
     
     Returns:
-        成功则返回仓位列表，超过重试时间则抛出异常
+        成功则返回仓位列表（数据未变化时返回 UNCHANGED），超过重试时间则抛出异常
     """
-    start_time = datetime.now()
+    start_time = time.monotonic()
     retry_count = 0
     
     while True:
         try:
-            return fetch_positions()
+            return await fetch_positions(session)
         
         except Exception as e:
-            elapsed = (datetime.now() - start_time).total_seconds()
+            elapsed = time.monotonic() - start_time
             retry_count += 1
             
-            error_msg = str(e)
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] "
-                  f"API调用失败 (第{retry_count}次): {error_msg}")
+            # aiohttp 超时抛出的 TimeoutError 文本为空，带上异常类型便于辨认
+            error_msg = f"{type(e).__name__}: {e}"
+            logger.warning("API调用失败 (第%d次): %s", retry_count, error_msg)
             
             # 检查是否超过最大重试时长
             if elapsed >= MAX_RETRY_DURATION:
@@ -209,17 +376,25 @@ def fetch_positions_with_retry() -> List[Dict[str, Any]]:
                     f"最后错误: {error_msg}"
                 )
             
-            # 等待后重试
+            # 指数退避 + 随机抖动后重试，避免固定间隔持续冲击限流中的接口
             remaining = MAX_RETRY_DURATION - elapsed
-            wait_time = min(RETRY_INTERVAL, remaining)
-            print(f"等待 {wait_time:.0f} 秒后重试... (剩余重试时间: {remaining:.0f}秒)")
-            time.sleep(wait_time)
+            backoff = min(RETRY_INTERVAL_BASE * (2 ** (retry_count - 1)), RETRY_INTERVAL_MAX)
+            wait_time = min(backoff + random.uniform(0, 1), remaining)
+            logger.info("等待 %.0f 秒后重试... (剩余重试时间: %.0f秒)", wait_time, remaining)
+            await asyncio.sleep(wait_time)
 
 # ================== 主循环 ==================
 
-def main():
+async def main():
+    async with create_session() as session:
+        await run(session)
+
+async def run(session: aiohttp.ClientSession):
     old_state = load_state()
-    send_feishu(
+    sent = load_dedup()
+    first_tick = True  # 仅重启后的首轮需要与已推送记录比对
+    await send_feishu(
+        session,
         f"✅ Polymarket 仓位监控 Bot 已启动\n"
         f"阈值设置：{CHANGE_THRESHOLD}\n"
         f"重试配置：{MAX_RETRY_DURATION}秒超时"
@@ -227,24 +402,34 @@ def main():
 
     while True:
         try:
-            positions = fetch_positions_with_retry()
-            alerts, new_state = detect_position_changes(old_state, positions)
-
-            for msg in alerts:
-                send_feishu(msg)
-
-            save_state(new_state)
-            old_state = new_state
+            positions = await fetch_positions_with_retry(session)
+
+            # 304 未变化：无需解析和比对
+            if positions is not UNCHANGED:
+                alerts, new_state = detect_position_changes(old_state, positions)
+                if first_tick:
+                    alerts = filter_sent_alerts(alerts, sent)
+                    first_tick = False
+
+                # 多条提醒合并为一条推送，超长时才拆分，拆分后按顺序逐条发送；
+                # 只记录推送成功的变化，失败的不会在重启后被误判为已推送
+                for batch in batch_alerts(alerts):
+                    if await send_feishu(session, ALERT_SEPARATOR.join(msg for _, msg in batch)):
+                        mark_sent(batch, sent)
+                        save_dedup(sent)
+
+                save_state(new_state)
+                old_state = new_state
             
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 监控正常")
+            logger.info("监控正常")
 
         except Exception as e:
-            error_msg = f"❌ 程序停止运行\n错误: {e}"
-            print(error_msg)
-            send_feishu(error_msg)
+            error_msg = f"❌ 程序停止运行\n错误: {type(e).__name__}: {e}"
+            logger.exception(error_msg)
+            await send_feishu(session, error_msg)
             break  # 停止程序
 
-        time.sleep(POLL_INTERVAL)
+        await asyncio.sleep(POLL_INTERVAL)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file